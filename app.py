@@ -1,150 +1,488 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
+import redis
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util import connection as urllib3_connection
+from urllib3.util.retry import Retry
+import hashlib
+import logging
+import msgspec
 import os
-from datetime import datetime
+import orjson
+import socket
+import threading
+import time
 from dotenv import load_dotenv
 load_dotenv(".env")
 
+# Per-request details are logged at DEBUG with lazy %-formatting, so they
+# cost nothing unless LOG_LEVEL=DEBUG is set
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+_log_level_valid = isinstance(logging.getLevelName(LOG_LEVEL), int)
+logging.basicConfig(level=LOG_LEVEL if _log_level_valid else logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
+if not _log_level_valid:
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize jsonify() responses with orjson instead of the stdlib encoder"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype=self.mimetype)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Configure CORS - Allow all origins for development
 # In production, replace "*" with your actual frontend domain
-CORS(app, origins=["*"], methods=["GET", "POST", "OPTIONS"], allow_headers=["*"])
+_CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*"
+}
+_PREFLIGHT_HEADERS = {
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Max-Age": "86400"
+}
+
+@app.after_request
+def add_cors_headers(response):
+    response.headers.update(_CORS_HEADERS)
+    return response
+
+# Preflight responses are the same for every route, so answer them
+# before routing to the view. Requested headers are echoed back because
+# browsers do not let a "*" wildcard cover Authorization.
+@app.before_request
+def handle_preflight():
+    if request.method == 'OPTIONS':
+        headers = _PREFLIGHT_HEADERS
+        requested = request.headers.get('Access-Control-Request-Headers')
+        if requested:
+            headers = {**headers, "Access-Control-Allow-Headers": requested}
+        return '', 204, headers
+
+# Compress JSON responses for clients that accept it
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_LEVEL'] = 5
+app.config['COMPRESS_MIN_SIZE'] = 256
+Compress(app)
 
 # Get OpenAI API key from environment variable
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+_KEY_CONFIGURED = bool(OPENAI_API_KEY)
+
+if not _KEY_CONFIGURED:
+    logger.warning("OPENAI_API_KEY environment variable not set")
+
+OPENAI_HOST = "api.openai.com"
+OPENAI_CLIENT_SECRETS_URL = f"https://{OPENAI_HOST}/v1/realtime/client_secrets"
+
+# The session config never changes, so serialize the request body once
+SESSION_CONFIG = {
+    "session": {
+        "type": "realtime",
+        "model": "gpt-realtime",
+        "audio": {
+            "output": {
+                "voice": "marin"  # Options: marin, lara, echo, onyx
+            }
+        },
+        "instructions": "You are a helpful voice assistant. Be conversational and friendly."
+    }
+}
+_BODY = orjson.dumps(SESSION_CONFIG)
+
+# (connect, read) timeout per attempt, and the longest Retry-After delay
+# honoured between attempts
+OPENAI_TIMEOUT = (3.05, 10)
+OPENAI_RETRY_AFTER_MAX = 3  # seconds
+
+# Retry transient OpenAI failures on the already-warm connection instead
+# of surfacing them to the browser; once retries are exhausted the last
+# response is returned so its error details reach the client
+_retry = Retry(
+    total=3,
+    connect=2,
+    read=2,
+    backoff_factor=0.3,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(['POST', 'GET']),
+    respect_retry_after_header=True,
+    retry_after_max=OPENAI_RETRY_AFTER_MAX,
+    raise_on_status=False
+)
+
+# Rough worst case for one token request (about 61s): every attempt runs
+# into both timeouts and every retry sleeps for the longest allowed
+# Retry-After (longer than any backoff). It is an estimate, not a limit:
+# each extra cached DNS address can add another connect timeout per
+# attempt, and gevent workers are not killed for slow requests (gunicorn's
+# timeout only catches a worker that stops heartbeating). It sizes the
+# Redis refresh lock below.
+OPENAI_REQUEST_BUDGET = (_retry.total + 1) * sum(OPENAI_TIMEOUT) + _retry.total * OPENAI_RETRY_AFTER_MAX
+
+# Shared HTTP session so the TLS connection to OpenAI is kept alive
+# and reused across requests instead of re-handshaking every call.
+# Only one host is ever contacted, so a single pool is enough. Usually
+# one refresh runs per process, but when it fails (or returns a token
+# without expires_at) every waiting request calls OpenAI in parallel, so
+# the pool keeps as many connections as a gevent worker serves clients
+# (gunicorn.conf.py); otherwise the extras would be opened and discarded.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=int(os.environ.get('WORKER_CONNECTIONS', 1000)),
+    max_retries=_retry
+))
+_session.headers.update({
+    "Authorization": f"Bearer {OPENAI_API_KEY}",
+    "Content-Type": "application/json",
+    "Accept-Encoding": "gzip"
+})
+
+# Only one host is ever contacted, so cache its resolved addresses instead
+# of calling getaddrinfo() for every new connection. A failed connect drops
+# the cache so the retry resolves again.
+DNS_CACHE_TTL = 60  # seconds
+_dns_cache = {"addrs": None, "exp": 0.0}
+_create_connection = urllib3_connection.create_connection
+
+def _create_cached_connection(address, *args, **kwargs):
+    host, port = address
+    if host != OPENAI_HOST:
+        return _create_connection(address, *args, **kwargs)
+
+    now = time.time()
+    if not _dns_cache["addrs"] or _dns_cache["exp"] <= now:
+        infos = socket.getaddrinfo(host, port, urllib3_connection.allowed_gai_family(), socket.SOCK_STREAM)
+        _dns_cache["addrs"] = list(dict.fromkeys(info[4][0] for info in infos))
+        _dns_cache["exp"] = now + DNS_CACHE_TTL
+
+    err = None
+    for addr in _dns_cache["addrs"]:
+        try:
+            return _create_connection((addr, port), *args, **kwargs)
+        except OSError as e:
+            err = e
+    _dns_cache["addrs"] = None
+    raise err
+
+urllib3_connection.create_connection = _create_cached_connection
+
+# Ephemeral tokens are reusable until shortly before expires_at, so cache
+# the last one instead of minting a new token for every client
+TOKEN_EXPIRY_MARGIN = 10  # seconds
+_token_cache = {"data": None, "exp": 0.0}
+
+# Concurrent cache misses share one in-flight refresh: the first request
+# fetches while the others wait on its Event. Only the bookkeeping is done
+# under the lock, never the OpenAI round trip itself.
+_token_lock = threading.Lock()
+_token_refresh = {"done": None}
+
+# When REDIS_URL is set the token is also shared through Redis, so every
+# gunicorn worker (and restarted workers) reuse the same token. The key is
+# tied to the session config so a config change never serves an old token.
+# Eviction (e.g. maxmemory-policy allkeys-lfu) is Redis server configuration
+# and is not set from here.
+REDIS_URL = os.environ.get('REDIS_URL')
+# The refresh lock must outlive the slowest possible OpenAI request, or a
+# second worker would start its own refresh while the first is retrying
+REFRESH_LOCK_TIMEOUT = int(OPENAI_REQUEST_BUDGET) + 5  # seconds
+REFRESH_POLL_INTERVAL = 0.1  # seconds
+_TOKEN_KEY = f"openai:ephemeral_token:{hashlib.sha256(_BODY).hexdigest()}"
+_TOKEN_STALE_KEY = f"{_TOKEN_KEY}:stale"
+_TOKEN_LOCK_KEY = f"{_TOKEN_KEY}:lock"
+_redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(REDIS_URL, max_connections=16)) if REDIS_URL else None
+
+class _TokenExpiry(msgspec.Struct):
+    """The only field of the OpenAI token response the backend reads"""
+    expires_at: float | None = None
+
+_decode_token_expiry = msgspec.json.Decoder(_TokenExpiry).decode
+
+def _token_expiry(body):
+    """Return expires_at from a token body, or None if it is missing or unusable"""
+    try:
+        return _decode_token_expiry(body).expires_at
+    except msgspec.DecodeError:
+        return None
+
+def _lookup_token(stale=False):
+    """
+    Return a cached token body or None. Fresh tokens are valid for longer
+    than TOKEN_EXPIRY_MARGIN; stale ones have merely not expired yet.
+    """
+    margin = 0 if stale else TOKEN_EXPIRY_MARGIN
+    if _token_cache["data"] and _token_cache["exp"] - margin > time.time():
+        return _token_cache["data"]
+    if _redis is None:
+        return None
+
+    try:
+        body = _redis.get(_TOKEN_STALE_KEY if stale else _TOKEN_KEY)
+    except redis.RedisError as e:
+        logger.warning("Redis token lookup failed: %s", e)
+        return None
+    if body:
+        _token_cache["data"] = body
+        _token_cache["exp"] = _token_expiry(body) or 0.0
+    return body
+
+def _store_token(body, expires_at):
+    """Cache a new token in-process and, if configured, in Redis"""
+    _token_cache["data"] = body
+    _token_cache["exp"] = expires_at
+    if _redis is None:
+        return
+
+    ttl = int(expires_at - time.time())
+    try:
+        if ttl > TOKEN_EXPIRY_MARGIN:
+            _redis.set(_TOKEN_KEY, body, ex=ttl - TOKEN_EXPIRY_MARGIN, nx=True)
+        if ttl > 0:
+            _redis.set(_TOKEN_STALE_KEY, body, ex=ttl)
+    except redis.RedisError as e:
+        logger.warning("Redis token store failed: %s", e)
+
+def _stale_token_or(error_response):
+    """Fall back to a cached, not yet expired token when OpenAI fails"""
+    body = _lookup_token(stale=True)
+    if body:
+        logger.warning("Serving cached token after OpenAI failure")
+        return _token_response(body)
+    return error_response
 
-if not OPENAI_API_KEY:
-    print("WARNING: OPENAI_API_KEY environment variable not set")
+def _token_response(body):
+    """Forward the raw OpenAI token body without re-serializing it"""
+    return Response(body, status=200, mimetype='application/json', headers={'Cache-Control': 'no-store'})
 
 @app.route('/api/token', methods=['GET', 'OPTIONS'])
 def get_ephemeral_token():
     """
     Generate an ephemeral token for client-side WebRTC connection
     """
-    if request.method == 'OPTIONS':
-        return '', 200
-        
-    if not OPENAI_API_KEY:
+    if not _KEY_CONFIGURED:
         return jsonify({"error": "OPENAI_API_KEY not configured"}), 500
     
-    session_config = {
-        "session": {
-            "type": "realtime",
-            "model": "gpt-realtime",
-            "audio": {
-                "output": {
-                    "voice": "marin"  # Options: marin, lara, echo, onyx
-                }
-            },
-            "instructions": "You are a helpful voice assistant. Be conversational and friendly."
-        }
-    }
-    
+    body = _lookup_token()
+    if body:
+        return _token_response(body)
+
+    with _token_lock:
+        done = _token_refresh["done"]
+        if done is None:
+            done = _token_refresh["done"] = threading.Event()
+            leader = True
+        else:
+            leader = False
+
+    if not leader:
+        # Reuse the in-flight refresh if it produced a token; if it failed,
+        # make our own request rather than queueing behind another one
+        done.wait()
+        body = _lookup_token()
+        if body:
+            return _token_response(body)
+        return _refresh_token()
+
     try:
-        print(f"Making request to OpenAI with session config: {json.dumps(session_config, indent=2)}")
-        
-        response = requests.post(
-            "https://api.openai.com/v1/realtime/client_secrets",
-            headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json=session_config,
-            timeout=30
-        )
-        
-        print(f"OpenAI Response Status: {response.status_code}")
-        print(f"OpenAI Response Headers: {dict(response.headers)}")
+        # A previous leader may have stored a token after our first lookup
+        body = _lookup_token()
+        if body:
+            return _token_response(body)
+        return _refresh_token()
+    finally:
+        with _token_lock:
+            _token_refresh["done"] = None
+        done.set()
+
+def _refresh_token():
+    """Fetch a new token, letting only one worker at a time call OpenAI"""
+    if _redis is None:
+        return _fetch_ephemeral_token()
+
+    # redis-py's Lock stores a unique token and releases with a
+    # compare-and-delete, so it never removes a lock another worker holds
+    lock = _redis.lock(_TOKEN_LOCK_KEY, timeout=REFRESH_LOCK_TIMEOUT, blocking=False)
+    try:
+        locked = lock.acquire()
+    except redis.RedisError as e:
+        logger.warning("Redis refresh lock failed: %s", e)
+        return _fetch_ephemeral_token()
+
+    if not locked:
+        return _wait_for_refresh()
+
+    try:
+        # Another worker may have published a token and released the lock
+        # between our cache miss and acquiring it
+        body = _lookup_token()
+        if body:
+            return _token_response(body)
+        return _fetch_ephemeral_token()
+    finally:
+        try:
+            lock.release()
+        except redis.RedisError as e:
+            logger.warning("Redis refresh lock release failed: %s", e)
+
+def _wait_for_refresh():
+    """Wait for the worker holding the refresh lock to publish its token"""
+    deadline = time.time() + REFRESH_LOCK_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(REFRESH_POLL_INTERVAL)
+        body = _lookup_token()
+        if body:
+            return _token_response(body)
+        try:
+            if not _redis.exists(_TOKEN_LOCK_KEY):
+                break
+        except redis.RedisError as e:
+            logger.warning("Redis refresh lock check failed: %s", e)
+            break
+
+    # The other worker failed (or Redis did); check once more, then fetch
+    body = _lookup_token()
+    if body:
+        return _token_response(body)
+    return _fetch_ephemeral_token()
+
+def _fetch_ephemeral_token():
+    """Request a new ephemeral token from OpenAI and cache it on success"""
+    try:
+        logger.debug("Requesting ephemeral token from OpenAI")
+        response = _session.post(OPENAI_CLIENT_SECRETS_URL, data=_BODY, timeout=OPENAI_TIMEOUT)
+        logger.debug("OpenAI status=%s", response.status_code)
         
         if response.status_code == 200:
-            data = response.json()
-            print(f"Token generated successfully. Expires at: {data.get('expires_at', 'unknown')}")
-            return jsonify(data)
+            body = response.content
+            expires_at = _token_expiry(body)
+            logger.info("Token generated successfully. Expires at: %s", expires_at or 'unknown')
+            if expires_at:
+                _store_token(body, float(expires_at))
+            return _token_response(body)
         else:
             error_text = response.text
-            print(f"OpenAI API Error: {response.status_code} - {error_text}")
-            return jsonify({
+            logger.error("OpenAI API Error: %s - %s", response.status_code, error_text)
+            error_response = jsonify({
                 "error": "Failed to generate token",
                 "details": error_text,
                 "status_code": response.status_code
             }), 500
+            if response.status_code == 429 or response.status_code >= 500:
+                return _stale_token_or(error_response)
+            return error_response
             
     except requests.exceptions.Timeout:
-        print("Request to OpenAI timed out")
-        return jsonify({"error": "Request timeout"}), 500
+        logger.error("Request to OpenAI timed out")
+        return _stale_token_or((jsonify({"error": "Request timeout"}), 500))
     except requests.exceptions.ConnectionError:
-        print("Connection error to OpenAI API")
-        return jsonify({"error": "Connection error"}), 500
+        logger.error("Connection error to OpenAI API")
+        return _stale_token_or((jsonify({"error": "Connection error"}), 500))
     except requests.exceptions.RequestException as e:
-        print(f"Request error: {str(e)}")
-        return jsonify({"error": f"Request failed: {str(e)}"}), 500
+        logger.error("Request error: %s", e)
+        return _stale_token_or((jsonify({"error": f"Request failed: {str(e)}"}), 500))
     except Exception as e:
-        print(f"Unexpected error: {str(e)}")
+        logger.exception("Unexpected error: %s", e)
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
+# Responses below never change (apart from their timestamps), so they
+# are serialized once at import time and timestamps are spliced in
+_HEALTH_BASE = {
+    "status": "healthy",
+    "service": "openai-realtime-backend",
+    "version": "1.0.0",
+    "api_key_configured": _KEY_CONFIGURED
+}
+_HEALTH_BODY_PREFIX = orjson.dumps(_HEALTH_BASE)[:-1] + b',"timestamp":"'
+_HEALTH_BODY_SUFFIX = b'"}'
+
+_TEST_BODY_PREFIX = orjson.dumps({
+    "message": "Backend is working!",
+    "endpoints": {
+        "health": "/api/health",
+        "token": "/api/token",
+        "test": "/api/test"
+    }
+})[:-1] + b',"timestamp":"'
+_TEST_BODY_SUFFIX = b'"}'
+
+_INDEX_BODY = orjson.dumps({
+    "service": "OpenAI Realtime API Backend",
+    "status": "running",
+    "endpoints": {
+        "health": "/api/health - Health check",
+        "token": "/api/token - Get ephemeral token",
+        "test": "/api/test - Test endpoint"
+    },
+    "cors": "Enabled for all origins",
+    "deployment": "Ready for Render"
+})
+
+_NOT_FOUND_BODY = orjson.dumps({
+    "error": "Endpoint not found",
+    "available_endpoints": ["/", "/api/health", "/api/token", "/api/test"]
+})
+
+_INTERNAL_ERROR_BODY = orjson.dumps({
+    "error": "Internal server error",
+    "message": "Something went wrong on the server"
+})
+
+def _static(body, code=200):
+    """Wrap a pre-serialized JSON body in a response"""
+    return Response(body, status=code, mimetype='application/json')
+
+# Health probes arrive several times a second, so the UTC timestamp is
+# formatted at most once per second
+_last_ts = [0, b""]
+
+def _cached_timestamp():
+    sec = int(time.time())
+    if sec != _last_ts[0]:
+        _last_ts[:] = [sec, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(sec)).encode()]
+    return _last_ts[1]
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
-        "status": "healthy", 
-        "timestamp": datetime.now().isoformat(),
-        "service": "openai-realtime-backend",
-        "version": "1.0.0",
-        "api_key_configured": bool(OPENAI_API_KEY)
-    })
+    return _static(_HEALTH_BODY_PREFIX + _cached_timestamp() + _HEALTH_BODY_SUFFIX)
 
 @app.route('/api/test', methods=['GET'])
 def test_endpoint():
     """Test endpoint to verify API is working"""
-    return jsonify({
-        "message": "Backend is working!",
-        "timestamp": datetime.now().isoformat(),
-        "endpoints": {
-            "health": "/api/health",
-            "token": "/api/token",
-            "test": "/api/test"
-        }
-    })
+    return _static(_TEST_BODY_PREFIX + _cached_timestamp() + _TEST_BODY_SUFFIX)
 
 @app.route('/', methods=['GET'])
 def index():
     """Root endpoint with API information"""
-    return jsonify({
-        "service": "OpenAI Realtime API Backend",
-        "status": "running",
-        "endpoints": {
-            "health": "/api/health - Health check",
-            "token": "/api/token - Get ephemeral token",
-            "test": "/api/test - Test endpoint"
-        },
-        "cors": "Enabled for all origins",
-        "deployment": "Ready for Render"
-    })
+    return _static(_INDEX_BODY)
 
 @app.errorhandler(404)
 def not_found(error):
-    return jsonify({
-        "error": "Endpoint not found",
-        "available_endpoints": ["/", "/api/health", "/api/token", "/api/test"]
-    }), 404
+    return _static(_NOT_FOUND_BODY, 404)
 
 @app.errorhandler(500)
 def internal_error(error):
-    return jsonify({
-        "error": "Internal server error",
-        "message": "Something went wrong on the server"
-    }), 500
+    return _static(_INTERNAL_ERROR_BODY, 500)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug_mode = os.environ.get('FLASK_ENV') == 'development'
     
-    print(f"Starting server on port {port}")
-    print(f"Debug mode: {debug_mode}")
-    print(f"OpenAI API Key configured: {bool(OPENAI_API_KEY)}")
+    logger.info("Starting server on port %s", port)
+    logger.info("Debug mode: %s", debug_mode)
+    logger.info("OpenAI API Key configured: %s", _KEY_CONFIGURED)
     
     app.run(debug=debug_mode, host='0.0.0.0', port=port)
 
@@ -0,0 +1,18 @@
+import multiprocessing
+import os
+
+# Gunicorn configuration - run with: gunicorn -c gunicorn.conf.py wsgi:app
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# gevent workers yield while waiting on the OpenAI request, so one worker
+# can serve many clients concurrently instead of blocking on each call.
+# Process and per-worker connection counts are tunable from the environment.
+worker_class = "gevent"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2 * multiprocessing.cpu_count() + 1))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+keepalive = 30
+timeout = 60
+
+# Access log to stdout; keep gunicorn's own logging to warnings and above
+accesslog = "-"
+loglevel = "warning"
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# app.py lives at the repository root and reads its config at import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
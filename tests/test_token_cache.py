@@ -0,0 +1,141 @@
+import threading
+import time
+
+import fakeredis
+import lupa  # noqa: F401 - fakeredis needs it to run redis-py's Lock scripts
+import orjson
+import pytest
+
+import app
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, expires_in=60):
+        self.status_code = status_code
+        self.content = orjson.dumps({"value": "ek_test", "expires_at": int(time.time()) + expires_in})
+        self.text = self.content.decode()
+
+
+@pytest.fixture
+def openai(monkeypatch):
+    """Replace the OpenAI call; tests set .status and may set .during_fetch"""
+    calls = []
+
+    def post(*args, **kwargs):
+        calls.append(kwargs)
+        if openai.during_fetch:
+            openai.during_fetch()
+        return FakeResponse(openai.status)
+
+    openai.calls = calls
+    openai.status = 200
+    openai.during_fetch = None
+    monkeypatch.setattr(app._session, "post", post)
+    return openai
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(app, "_redis", client)
+    monkeypatch.setattr(app, "REFRESH_POLL_INTERVAL", 0.01)
+    return client
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(app, "_token_cache", {"data": None, "exp": 0.0})
+
+
+def get_token():
+    return app.app.test_client().get("/api/token")
+
+
+def forget_local_token():
+    """Simulate another worker: nothing cached in this process"""
+    app._token_cache.update(data=None, exp=0.0)
+
+
+def test_token_is_shared_between_workers(openai, redis_client):
+    assert get_token().status_code == 200
+    forget_local_token()
+    assert get_token().status_code == 200
+    assert len(openai.calls) == 1
+
+
+def test_lock_holder_reuses_token_published_before_it_got_the_lock(openai, redis_client):
+    # Another worker refreshed and released the lock after our cache miss
+    assert get_token().status_code == 200
+    forget_local_token()
+
+    with app.app.test_request_context("/api/token"):
+        response = app._refresh_token()
+    assert response.status_code == 200
+    assert len(openai.calls) == 1
+    assert not redis_client.exists(app._TOKEN_LOCK_KEY)
+
+
+def test_lock_release_keeps_lock_taken_by_another_worker(openai, redis_client, monkeypatch):
+    monkeypatch.setattr(app, "REFRESH_LOCK_TIMEOUT", 1)
+    other = redis_client.lock(app._TOKEN_LOCK_KEY, timeout=30, blocking=False)
+
+    def lock_expires_and_is_retaken():
+        redis_client.delete(app._TOKEN_LOCK_KEY)
+        assert other.acquire()
+
+    openai.during_fetch = lock_expires_and_is_retaken
+    assert get_token().status_code == 200
+    assert other.owned()
+
+
+def test_waiter_uses_token_published_by_lock_holder(openai, redis_client):
+    holder = redis_client.lock(app._TOKEN_LOCK_KEY, timeout=30, blocking=False, thread_local=False)
+    assert holder.acquire()
+
+    def publish():
+        time.sleep(0.2)
+        redis_client.set(app._TOKEN_KEY, FakeResponse().content, ex=30)
+        holder.release()
+
+    threading.Thread(target=publish).start()
+    response = get_token()
+    assert response.status_code == 200
+    assert openai.calls == []
+
+
+def test_waiter_fetches_itself_when_lock_holder_fails(openai, redis_client):
+    holder = redis_client.lock(app._TOKEN_LOCK_KEY, timeout=30, blocking=False, thread_local=False)
+    assert holder.acquire()
+    threading.Timer(0.2, holder.release).start()
+
+    start = time.time()
+    assert get_token().status_code == 200
+    assert time.time() - start < 5
+    assert len(openai.calls) == 1
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_stale_token_served_when_openai_fails(openai, redis_client, status):
+    assert get_token().status_code == 200
+    forget_local_token()
+    redis_client.delete(app._TOKEN_KEY)
+
+    openai.status = status
+    response = get_token()
+    assert response.status_code == 200
+    assert b"ek_test" in response.data
+    assert len(openai.calls) == 2
+
+
+def test_error_returned_when_no_token_to_fall_back_on(openai, redis_client):
+    openai.status = 503
+    assert get_token().status_code == 500
+
+
+def test_redis_errors_fall_back_to_openai(openai, monkeypatch):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr(app, "_redis", fakeredis.FakeRedis(server=server))
+
+    assert get_token().status_code == 200
+    assert len(openai.calls) == 1
@@ -0,0 +1,6 @@
+# Patch the standard library before anything else is imported so that
+# requests' sockets cooperate with gevent workers
+from gevent import monkey
+monkey.patch_all()
+
+from app import app  # noqa: E402